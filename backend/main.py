@@ -1,32 +1,50 @@
 import asyncio
+import datetime
 import json
 import logging
 import os
+import orjson
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from typing import Dict, AsyncGenerator
+from collections import defaultdict
 import aiohttp
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, aclosing
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 from livekit import agents, rtc
-from livekit.agents import JobContext, WorkerOptions, cli
-from livekit.agents.llm import ChatContext, ChatMessage
 from livekit.plugins import assemblyai
 import time
 
 # Load env
 load_dotenv()
 
+# uvloop speeds up all the asyncio I/O here (LiveKit/AssemblyAI websockets, SSE fan-out)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    uvloop = None
+
 # Configuration
 LIVEKIT_URL = os.getenv("LIVEKIT_URL")
 LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY")
 LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
 TRANSCRIBE_PROVIDER = os.getenv("TRANSCRIBE_PROVIDER", "assemblyai")
 
-# Setup Logging
+# Setup Logging: hand records to a background listener thread so formatting
+# and stream I/O never run on the event loop
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("transcriber-agent")
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+logger.addHandler(QueueHandler(_log_queue))
+logger.propagate = False
 
 http_session: aiohttp.ClientSession = None
 
@@ -36,6 +54,8 @@ async def lifespan(app: FastAPI):
     http_session = aiohttp.ClientSession()
     yield
     await http_session.close()
+    # Flush records still queued at shutdown
+    _log_listener.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -49,131 +69,172 @@ app.add_middleware(
 )
 
 # Global state to hold room transcripts/queues
-# roomId -> list of queues (one per connected SSE client)
-transcript_queues: Dict[str, list[asyncio.Queue]] = {}
+# roomId -> set of queues (one per connected SSE client)
+transcript_queues: Dict[str, set[asyncio.Queue]] = defaultdict(set)
 
-def get_stt_plugin():
-    # if TRANSCRIBE_PROVIDER == "openai":
-    #     return openai.STT()
-    # elif TRANSCRIBE_PROVIDER == "assemblyai":
-    #     return assemblyai.STT()
-    # else:
-        # Fallback or default
-        return assemblyai.STT(http_session=http_session)
-
-class TranscriberAgent:
-    def __init__(self, ctx: JobContext, room_id: str):
-        self.ctx = ctx
-        self.room_id = room_id
-        self.stt = get_stt_plugin()
-        self.participants: Dict[str, rtc.Participant] = {}
-
-    async def start(self):
-        logger.info(f"Starting agent for room {self.room_id}")
-        await self.ctx.connect(auto_subscribe=agents.AutoSubscribe.AUDIO_ONLY)
-
-        @self.ctx.room.on("track_subscribed")
-        def on_track_subscribed(track: rtc.Track, publication: rtc.TrackPublication, participant: rtc.RemoteParticipant):
-            if track.kind == rtc.TrackKind.KIND_AUDIO:
-                asyncio.create_task(self.transcribe_track(track, participant))
-
-        # Handle participants already in the room
-        for participant in self.ctx.room.remote_participants.values():
-            for publication in participant.track_publications.values():
-                if publication.track and publication.track.kind == rtc.TrackKind.KIND_AUDIO:
-                    asyncio.create_task(self.transcribe_track(publication.track, participant))
-
-    async def transcribe_track(self, track: rtc.AudioTrack, participant: rtc.RemoteParticipant):
-        logger.info(f"Transcribing track {track.sid} from {participant.identity}")
-        stream = self.stt.stream()
-        
-        async def audio_stream_feeder():
-            async for frame in rtc.AudioStream(track):
-                stream.push_frame(frame)
-            stream.end_input()
-        
-        asyncio.create_task(audio_stream_feeder())
-
-        async for event in stream:
-            if event.type == agents.stt.SpeechEventType.FINAL_TRANSCRIPT:
-                # We have a transcript
-                text = event.alternatives[0].text
-                if not text:
-                    continue
-                
-                # Resolve name
-                name = participant.name or participant.identity
-                # Check metadata if name is missing or we want to prefer metadata
-                if participant.metadata:
-                    try:
-                        md = json.loads(participant.metadata)
-                        if "displayName" in md:
-                            name = md["displayName"]
-                    except:
-                        pass
-
-                msg = {
-                    "roomId": self.room_id,
-                    "timestamp": asyncio.get_event_loop().time(), # or isoformat
-                    "participantIdentity": participant.identity,
-                    "participantName": name,
-                    "text": text
-                }
-                
-                logger.info(f"Transcript: {name}: {text}")
-                await self.broadcast_transcript(self.room_id, msg)
+# Cap per-subscriber queues so a slow SSE client can't grow memory unboundedly
+# or stall the STT ingest loop; on overflow we drop its oldest frame instead.
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# Coalesce 10-20ms capture frames into chunks of this size before pushing to
+# the STT stream, amortizing the per-frame object + queue-hop overhead.
+STT_CHUNK_MS = 100
+
+def queue_put_drop_oldest(room_id: str, q: asyncio.Queue, payload: bytes):
+    try:
+        q.put_nowait(payload)
+    except asyncio.QueueFull:
+        try:
+            q.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        q.put_nowait(payload)
+        q.dropped += 1
+        logger.warning("Slow SSE subscriber for room %s, dropped %d frames", room_id, q.dropped)
+
+def broadcast_transcript(room_id: str, payload: bytes):
+    # put_nowait keeps this one synchronous pass over all subscribers: every
+    # queue is filled in the same event-loop iteration, with no per-queue
+    # awaits (and hence no need for gather) and no latency skew between the
+    # first and last subscriber.
+    for q in transcript_queues.get(room_id, ()):
+        queue_put_drop_oldest(room_id, q, payload)
+
+# (room_id, identity) -> precomputed display name. Populated from participant
+# lifecycle events so the transcript hot path is a plain dict lookup, never
+# JSON parsing. Keyed per room: the same identity can sit in several rooms,
+# and one room's disconnect must not evict another room's entry.
+participants_meta: Dict[tuple, str] = {}
 
-    async def broadcast_transcript(self, room_id: str, message: dict):
-        if room_id in transcript_queues:
-            for q in transcript_queues[room_id]:
-                await q.put(message)
+def update_participant_name(room_id: str, participant: rtc.Participant):
+    name = participant.name or participant.identity
+    if participant.metadata:
+        try:
+            md = json.loads(participant.metadata)
+            if "displayName" in md:
+                name = md["displayName"]
+        except (ValueError, TypeError):
+            pass
+    participants_meta[(room_id, participant.identity)] = name
+
+# Single shared STT plugin; each .stream() call still opens its own
+# independent session to the provider.
+_stt_plugin = None
+
+def get_stt_plugin():
+    global _stt_plugin
+    if _stt_plugin is None:
+        # if TRANSCRIBE_PROVIDER == "openai":
+        #     _stt_plugin = openai.STT()
+        # else:
+        _stt_plugin = assemblyai.STT(http_session=http_session)
+    return _stt_plugin
 
 running_agents: Dict[str, asyncio.Task] = {}
 
+# Serializes /attach-transcriber per room so racing POSTs can't both miss
+# running_agents and spawn two agent connections for the same room.
+_attach_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# room_id -> signed agent JWT; skips re-signing on reconnects. Entries are
+# evicted when the room's agent task exits so a later attach signs fresh.
+_agent_tokens: Dict[str, str] = {}
+
+def get_agent_token(room_id: str) -> str:
+    token = _agent_tokens.get(room_id)
+    if token is None:
+        from livekit import api
+        token = api.AccessToken(LIVEKIT_API_KEY, LIVEKIT_API_SECRET) \
+            .with_identity("transcriber-bot-" + room_id) \
+            .with_name("Transcriber") \
+            .with_grants(api.VideoGrants(room_join=True, room=room_id, can_publish=False, can_subscribe=True, hidden=True)) \
+            .to_jwt()
+        _agent_tokens[room_id] = token
+    return token
+
 async def run_agent_for_room(room_id: str):
     room = rtc.Room()
     # We need a token for the agent
-    from livekit import api
-    token_verifier = api.AccessToken(LIVEKIT_API_KEY, LIVEKIT_API_SECRET) \
-        .with_identity("transcriber-bot-" + room_id) \
-        .with_name("Transcriber") \
-        .with_grants(api.VideoGrants(room_join=True, room=room_id, can_publish=False, can_subscribe=True, hidden=True))
-    
-    token = token_verifier.to_jwt()
+    token = get_agent_token(room_id)
 
     async def room_task():
+        shutdown = asyncio.Event()
+        # Strong refs so spawned tasks can't be garbage-collected mid-run,
+        # keyed by track.sid to dedupe (existing-track loop can race
+        # track_subscribed) and to cancel on unsubscribe
+        track_tasks: Dict[str, asyncio.Task] = {}
+
+        def spawn_transcription(track, participant, stt):
+            if track.sid in track_tasks:
+                return
+            t = asyncio.create_task(transcribe(track, participant, stt, room_id))
+            track_tasks[track.sid] = t
+
+            def cleanup(_t, sid=track.sid):
+                # Only evict our own entry: on a fast unsubscribe/resubscribe
+                # the sid may already map to a newer live task
+                if track_tasks.get(sid) is _t:
+                    del track_tasks[sid]
+
+            t.add_done_callback(cleanup)
+
         try:
             await room.connect(LIVEKIT_URL, token)
             logger.info(f"Connected to room {room_id}")
+
+            @room.on("disconnected")
+            def on_disconnected(*args):
+                shutdown.set()
             
             # Setup STT
             stt = get_stt_plugin()
             
+            @room.on("participant_connected")
+            def on_participant_connected(participant: rtc.RemoteParticipant):
+                update_participant_name(room_id, participant)
+
+            @room.on("participant_metadata_changed")
+            def on_metadata_changed(participant, *args):
+                update_participant_name(room_id, participant)
+
             @room.on("track_subscribed")
             def on_track_subscribed(track, publication, participant):
                 if track.kind == rtc.TrackKind.KIND_AUDIO:
-                    asyncio.create_task(handle_audio_track(track, participant, stt, room_id))
+                    spawn_transcription(track, participant, stt)
+
+            @room.on("track_unsubscribed")
+            def on_track_unsubscribed(track, publication, participant):
+                t = track_tasks.pop(track.sid, None)
+                if t:
+                    t.cancel()
 
-            # Handle existing tracks
+            # Handle existing participants and tracks
             for p in room.remote_participants.values():
+                update_participant_name(room_id, p)
                 for pub in p.track_publications.values():
                     if pub.track and pub.track.kind == rtc.TrackKind.KIND_AUDIO:
-                        asyncio.create_task(handle_audio_track(pub.track, p, stt, room_id))
+                        spawn_transcription(pub.track, p, stt)
             
             @room.on("participant_disconnected")
             def on_participant_disconnected(participant: rtc.RemoteParticipant):
+                participants_meta.pop((room_id, participant.identity), None)
                 if len(room.remote_participants) == 0:
                     logger.info(f"Room {room_id} is empty, disconnecting agent.")
-                    asyncio.create_task(room.disconnect())
+                    shutdown.set()
+
+            # Keep alive until room is empty or closed (disconnect happens in finally)
+            await shutdown.wait()
 
-            # Keep alive until room is empty or closed
-            while room.connection_state == rtc.ConnectionState.CONN_CONNECTED:
-                await asyncio.sleep(1)
-                
         except Exception as e:
             logger.error(f"Error in agent for room {room_id}: {e}")
         finally:
+            for t in list(track_tasks.values()):
+                t.cancel()
             await room.disconnect()
+            for key in [k for k in participants_meta if k[0] == room_id]:
+                participants_meta.pop(key, None)
+            _agent_tokens.pop(room_id, None)
+            _attach_locks.pop(room_id, None)
             if room_id in running_agents:
                 del running_agents[room_id]
 
@@ -181,50 +242,63 @@ async def run_agent_for_room(room_id: str):
     running_agents[room_id] = task
     return task
 
-async def handle_audio_track(track: rtc.AudioTrack, participant: rtc.RemoteParticipant, stt, room_id):
-    stream = stt.stream()
-    
-    async def feed_audio():
-        # rtc.AudioStream needs to be closed properly?
-        audio_stream = rtc.AudioStream(track)
-        async for frame in audio_stream:
-            stream.push_frame(frame.frame)
+async def transcribe(track: rtc.AudioTrack, participant: rtc.RemoteParticipant, stt, room_id):
+    async def feed_audio(stream):
+        buf = bytearray()
+        sample_rate = num_channels = target = 0
+
+        def flush():
+            stream.push_frame(rtc.AudioFrame(
+                bytes(buf), sample_rate, num_channels,
+                len(buf) // (2 * num_channels)))
+            buf.clear()
+
+        async with aclosing(rtc.AudioStream(track)) as audio_stream:
+            async for event in audio_stream:
+                frame = event.frame
+                if not target:
+                    sample_rate, num_channels = frame.sample_rate, frame.num_channels
+                    # 16-bit samples
+                    target = sample_rate * num_channels * 2 * STT_CHUNK_MS // 1000
+                buf += frame.data
+                if len(buf) >= target:
+                    flush()
+        if buf:
+            flush()
         stream.end_input()
-        
-    asyncio.create_task(feed_audio())
-    
-    async for event in stream:
-        if event.type == agents.stt.SpeechEventType.FINAL_TRANSCRIPT:
-            text = event.alternatives[0].text
-            if text:
-                 # Resolve name
-                name = participant.name or participant.identity
-                if participant.metadata:
-                    try:
-                        md = json.loads(participant.metadata)
-                        if "displayName" in md:
-                            name = md["displayName"]
-                    except:
-                        pass
-                
-                # Format Timestamp
-                import datetime
-                timestamp = datetime.datetime.now().isoformat()
-
-                msg = {
-                    "roomId": room_id,
-                    "timestamp": timestamp,
-                    "participantIdentity": participant.identity,
-                    "participantName": name,
-                    "text": text
-                }
-                
-                logger.info(f"[{room_id}] {name}: {text}")
+
+    # Both streams are closed on exit so track churn can't leak fds/tasks
+    async with aclosing(stt.stream()) as stream:
+        feeder = asyncio.create_task(feed_audio(stream))
+        try:
+            async for event in stream:
+                if event.type == agents.stt.SpeechEventType.FINAL_TRANSCRIPT:
+                    text = event.alternatives[0].text
+                    if text:
+                         # Resolve name (precomputed at participant lifecycle events)
+                        name = participants_meta.get((room_id, participant.identity)) or participant.name or participant.identity
+
+                        # Format Timestamp (ISO string, parsed by the frontend)
+                        timestamp = datetime.datetime.now().isoformat()
+
+                        msg = {
+                            "roomId": room_id,
+                            "timestamp": timestamp,
+                            "participantIdentity": participant.identity,
+                            "participantName": name,
+                            "text": text
+                        }
                 
-                # Broadcast
-                if room_id in transcript_queues:
-                    for q in transcript_queues[room_id]:
-                        await q.put(msg)
+                        # Lazy %-formatting at DEBUG only: per-transcript f-strings
+                        # would be built even when the level filters them out
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("[%s] %s: %s", room_id, name, text)
+
+                        # Broadcast: serialize the SSE frame once, share it across subscribers
+                        payload = b"data: " + orjson.dumps(msg) + b"\n\n"
+                        broadcast_transcript(room_id, payload)
+        finally:
+            feeder.cancel()
 
 @app.post("/attach-transcriber")
 async def attach_transcriber(body: dict):
@@ -232,40 +306,53 @@ async def attach_transcriber(body: dict):
     if not room_id:
         raise HTTPException(status_code=400, detail="roomId required")
     
-    if room_id in running_agents:
-        return {"status": "already_running"}
-    
-    await run_agent_for_room(room_id)
+    async with _attach_locks[room_id]:
+        if room_id in running_agents:
+            return {"status": "already_running"}
+
+        await run_agent_for_room(room_id)
     return {"status": "started"}
 
 @app.get("/transcript-stream")
-async def transcript_stream(roomId: str, request: Request):
+async def transcript_stream(roomId: str):
     async def event_generator():
-        q = asyncio.Queue()
-        if roomId not in transcript_queues:
-            transcript_queues[roomId] = []
-        transcript_queues[roomId].append(q)
+        q = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        q.dropped = 0
+        transcript_queues[roomId].add(q)
         
         try:
+            # Pre-framed bytes pass through EventSourceResponse untouched;
+            # keepalives and disconnects are handled by sse-starlette.
             while True:
-                if await request.is_disconnected():
-                    break
-                # Wait for new transcript
-                # Use a timeout to send keepalives if needed
-                try:
-                    data = await asyncio.wait_for(q.get(), timeout=15.0)
-                    yield f"data: {json.dumps(data)}\n\n"
-                except asyncio.TimeoutError:
-                    # Send comment to keep connection alive
-                    yield ": keepalive\n\n"
+                yield await q.get()
         finally:
-            if roomId in transcript_queues:
-                transcript_queues[roomId].remove(q)
-                if not transcript_queues[roomId]:
-                    del transcript_queues[roomId]
+            transcript_queues[roomId].discard(q)
+            if not transcript_queues[roomId]:
+                transcript_queues.pop(roomId, None)
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return EventSourceResponse(
+        event_generator(),
+        ping=15,
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"},
+    )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+    # transcript_queues / running_agents are in-process state: with multiple
+    # workers, /attach-transcriber on one worker would be invisible to SSE
+    # clients on another. Scale vertically, or move fan-out to a broker
+    # (e.g. Redis pub/sub) before raising this.
+    workers = int(os.getenv("WEB_CONCURRENCY", os.getenv("WORKERS", "1")))
+    if workers != 1:
+        logger.warning("Forcing workers=1: transcript state is per-process")
+        workers = 1
+    # Pass the app object, not an import string: with "main:app" uvicorn
+    # re-imports this module, running the logging/uvloop setup twice.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop" if uvloop else "auto",
+        http="httptools",
+        workers=workers,
+    )